@@ -22,34 +22,99 @@
 #
 
 import argparse
+import atexit
 import json
 import logging
+import queue
 import sys
-import traceback
+from itertools import count
+from logging.handlers import QueueHandler, QueueListener
 from pprint import pformat
 from signal import SIG_DFL, SIGINT, SIGTERM, signal
-from typing import Optional
+from typing import Callable, Optional
 from urllib.parse import ParseResult, urlparse
 
 from pyhomematic import HMConnection
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+
+class BufferedStreamHandler(logging.StreamHandler):
+    """A StreamHandler that doesn't flush after every record."""
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+
+class FlushingQueueListener(QueueListener):
+    """A QueueListener that flushes its handlers once the queue is drained."""
+
+    def handle(self, record: logging.LogRecord) -> None:
+        super().handle(record)
+        if self.queue.empty():
+            for handler in self.handlers:
+                handler.flush()
+
+
 logger = logging.getLogger(__name__)
-logger.addHandler(logging.StreamHandler(sys.stdout))
 logger.setLevel(logging.INFO)
 
-KNOWN_DEVICES = {
-    "HmIP-BROLL",
-    "HmIP-RCV-50",
-    "HmIP-SRH",
-    "HmIP-SWSD",
-}
+# Records are written to stdout by a background thread, so that the XML-RPC
+# callbacks don't block on the console. Bursts of records, e.g. from
+# newDevices, get written with a single flush.
+log_queue = queue.SimpleQueue()
+logger.addHandler(QueueHandler(log_queue))
+log_stream = open(
+    sys.stdout.fileno(),
+    "w",
+    buffering=8192,
+    encoding=sys.stdout.encoding,
+    closefd=False,
+)
+log_listener = FlushingQueueListener(log_queue, BufferedStreamHandler(log_stream))
+log_listener.start()
+atexit.register(log_listener.stop)
+
+
+def make_emitter(level: int, msg: str) -> Callable[..., None]:
+    """Return a function logging msg at level, skipping the caller lookup."""
+
+    def emit(*args) -> None:
+        if logger.isEnabledFor(level):
+            record = logger.makeRecord(
+                logger.name, level, "(unknown file)", 0, msg, args, None
+            )
+            logger.handle(record)
+
+    return emit
+
+
+log_event = make_emitter(logging.INFO, "events += [%r, %r, %r]")
+log_skip = make_emitter(logging.INFO, "# Skipping devices of type %s")
+
+KNOWN_DEVICES = frozenset(
+    {
+        "HmIP-BROLL",
+        "HmIP-RCV-50",
+        "HmIP-SRH",
+        "HmIP-SWSD",
+    }
+)
 
 
 class HomematicInventory:
+    __slots__ = ("_devices", "_skipped", "_serial")
+
     def __init__(self):
         self._devices = {}
         self._skipped = set()
-        self._serial = 1
+        self._serial = count(1)
 
         logger.info("devices = []")
         logger.info("events = []")
@@ -58,12 +123,13 @@ class HomematicInventory:
         self, interface_id: str, address: str, value_key: str, value: str
     ) -> None:
         try:
-            address = address.split(":")[0]
             alias = self._devices.get(address)
+            if not alias:
+                alias = self._devices.get(address.partition(":")[0])
             if alias:
-                logger.info("events += %s", pformat([alias, value_key, value]))
+                log_event(alias, value_key, value)
         except Exception:
-            logger.error(traceback.format_exc())
+            logger.exception("Event callback failed")
             raise
 
     def _system_callback(self, src: str, *args) -> None:
@@ -71,45 +137,44 @@ class HomematicInventory:
             if src == "newDevices" and len(args) >= 2:
                 for device in args[1]:
                     parent = device["PARENT"]
-                    if parent:
-                        device_type = device["PARENT_TYPE"]
-                        address = parent
-                    else:
-                        device_type = device["TYPE"]
-                        address = device["ADDRESS"]
-
+                    device_type = device["PARENT_TYPE" if parent else "TYPE"]
                     if device_type in KNOWN_DEVICES:
                         if device_type not in self._skipped:
-                            logger.info(
-                                "# Skipping devices of type %s", device_type
-                            )
-                        self._skipped.add(device_type)
+                            log_skip(device_type)
+                            self._skipped.add(device_type)
                         continue
 
+                    address = parent or device["ADDRESS"]
+
                     alias = self._devices.get(address)
                     if not alias:
-                        alias = f"{self._serial:014X}"
-                        self._serial += 1
+                        alias = f"{next(self._serial):014X}"
                         self._devices[address] = alias
 
                     if parent:
+                        # Map the channel address, too, to save a split
+                        # on every event.
+                        self._devices[device["ADDRESS"]] = alias
                         index = device["INDEX"]
                         device["ADDRESS"] = f"{alias}:{index}"
                         device["PARENT"] = alias
                     else:
                         device["ADDRESS"] = alias
-                        for n, child in enumerate(device["CHILDREN"]):
-                            device["CHILDREN"][n] = child.replace(
-                                address, alias
-                            )
+                        device["CHILDREN"] = [
+                            alias + child[len(address) :]
+                            if child.startswith(address)
+                            else child
+                            for child in device["CHILDREN"]
+                        ]
                         device["RF_ADDRESS"] = 0
 
-                    logger.info("devices += %s", pformat([device]))
+                    if logger.isEnabledFor(logging.INFO):
+                        logger.info("devices += %s", pformat([device]))
         except Exception:
-            logger.error(traceback.format_exc())
+            logger.exception("System callback failed")
             raise
 
-    def _xmlrpc_listen_url(self, url: str) -> Optional[ParseResult]:
+    def _xmlrpc_url(self, url: str) -> Optional[ParseResult]:
         if "://" not in url:
             url = f"//{url}"
         p = urlparse(url, scheme="xmlrpc")
@@ -119,16 +184,12 @@ class HomematicInventory:
             raise ValueError("Missing hostname")
         return p
 
-    def _xmlrpc_connect_url(self, url: str) -> Optional[ParseResult]:
-        p = self._xmlrpc_listen_url(url)
-        if not p.port:
-            raise ValueError("Missing port number")
-        return p
-
     def run(self, listen: str, connect: str) -> None:
         try:
-            xmlrpc_local = self._xmlrpc_listen_url(listen)
-            xmlrpc_remote = self._xmlrpc_connect_url(connect)
+            xmlrpc_local = self._xmlrpc_url(listen)
+            xmlrpc_remote = self._xmlrpc_url(connect)
+            if not xmlrpc_remote.port:
+                raise ValueError("Missing port number")
         except ValueError as exc:
             logger.error("Invalid XML-RPC URL: %s", exc)
             sys.exit(1)
@@ -187,8 +248,8 @@ def options() -> dict:
     filename = args.config or cfg["config"]
 
     try:
-        with open(filename, "r") as f:
-            cfg.update(json.load(f))
+        with open(filename, "rb") as f:
+            cfg.update(json_loads(f.read()))
     except OSError as exc:
         if args.config or not isinstance(exc, FileNotFoundError):
             logger.error("Failed to open configuration file: %s", exc)
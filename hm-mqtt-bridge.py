@@ -25,35 +25,71 @@ import argparse
 import asyncio
 import json
 import logging
+import re
 import ssl
 import sys
-from functools import partial
-from typing import Optional, Union
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Optional, Tuple, Union
 from urllib.parse import urlparse
 
 from asyncio_mqtt import Client, MqttError, Will
 from pyhomematic import HMConnection
 from pyhomematic.devicetypes.actors import GenericBlind, GenericSwitch
 
+try:
+    from orjson import dumps as json_dumps
+    from orjson import loads as json_loads
+except ImportError:
+    json_dumps = json.JSONEncoder(separators=(",", ":")).encode
+    from json import loads as json_loads
+
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.StreamHandler())
 
 
 HM_COVER_CHANNEL_MAP = {4: 3}
 
+# Seconds to wait for more changes before publishing a channel's attributes
+ATTRIBUTES_DELAY = 0.1
+
 MQTT_PREFIX = "Homematic"
+DISCOVERY_PREFIX = "homeassistant"
+MQTT_KEEPALIVE = 60
+MQTT_RECONNECT_DELAY_MIN = 1
+MQTT_RECONNECT_DELAY_MAX = 30
+
+# <prefix>/<address>/<channel>/<command>
+COMMAND_TOPIC_RE = re.compile(rf"{re.escape(MQTT_PREFIX)}/([^/]+)/(\d+)/(action|set_level)")
+
+# Number of retained payloads remembered to suppress duplicates
+LAST_SENT_MAX = 10000
+
+# Number of queued messages which, while disconnected, triggers dropping
+# all but the latest message of each retained topic
+OUTBOX_MAX = 10000
+
+# Maximum number of commands being sent to the CCU in parallel
+COMMAND_CONCURRENCY = 8
+# Commands shouldn't get lost or be executed twice. Publishes use QoS 0
+# (state) or 1 (discovery), since retained state is idempotent.
+COMMAND_QOS = 2
 HM_INTERFACE_ID = "mqttbridge"
 HM_REMOTE = "default"
+# Interface ID used by pyhomematic in callbacks
+HM_EXPECTED_INTERFACE_ID = sys.intern(f"{HM_INTERFACE_ID}-{HM_REMOTE}")
 
-BINARY_SENSOR_TYPES = {
+BINARY_SENSOR_TYPES = frozenset({
     "MAINTENANCE",
-}
+})
 
-COVER_TYPES = {"SHUTTER_VIRTUAL_RECEIVER"}
+COVER_TYPES = frozenset({"SHUTTER_VIRTUAL_RECEIVER"})
 
-DEVICE_TRIGGER_TYPES = {"KEY_TRANSCEIVER"}
+DEVICE_TRIGGER_TYPES = frozenset({"KEY_TRANSCEIVER"})
 
-SENSOR_TYPES = {
+SENSOR_TYPES = frozenset({
     "ALARM_COND_SWITCH_TRANSMITTER",
     "BLIND_WEEK_PROFILE",
     "COND_SWITCH_TRANSMITTER",
@@ -63,17 +99,26 @@ SENSOR_TYPES = {
     "SMOKE_DETECTOR",
     "SWITCH_TRANSMITTER",
     "SWITCH_WEEK_PROFILE",
-}
+})
 
-SWITCH_TYPES = {
+SWITCH_TYPES = frozenset({
     "SWITCH_VIRTUAL_RECEIVER",
+})
+
+# Home Assistant component of each channel type, looked up once per channel
+CHANNEL_COMPONENTS = {
+    **dict.fromkeys(BINARY_SENSOR_TYPES, "binary_sensor"),
+    **dict.fromkeys(COVER_TYPES, "cover"),
+    **dict.fromkeys(DEVICE_TRIGGER_TYPES, "device_automation"),
+    **dict.fromkeys(SENSOR_TYPES, "sensor"),
+    **dict.fromkeys(SWITCH_TYPES, "switch"),
 }
 
 SENSOR_UNITS = {
     "SHUTTER_TRANSMITTER": "%",
 }
 
-MAINTENANCE_FLAGS = {
+MAINTENANCE_FLAGS = frozenset(
     flag.lower()
     for flag in (
         "ACTUAL_TEMPERATURE_STATUS",
@@ -87,65 +132,271 @@ MAINTENANCE_FLAGS = {
         "TIME_OF_OPERATION_STATUS",
         "UNREACH",
     )
+)
+
+# Static parts of the discovery configs
+COVER_TEMPLATE = {
+    "device_class": "shutter",
+    "payload_close": "move_down",
+    "payload_open": "move_up",
+    "payload_stop": "stop",
+    "position_closed": 0,
+    "position_open": 100,
+    "set_position_template": "{{ position / 100 }}",
 }
 
-ROTARY_HANDLE_VALUES = {
-    0: "closed",
-    1: "tilted",
-    2: "open",
+DEVICE_TRIGGER_TEMPLATE = {
+    "automation_type": "trigger",
 }
-SMOKE_DETECTOR_VALUES = {
-    0: "off",
-    1: "primary",
-    2: "intrusion",
-    3: "secondary",
+
+SWITCH_TEMPLATE = {
+    "payload_off": "off",
+    "payload_on": "on",
+    "state_off": "OFF",
+    "state_on": "ON",
 }
 
+# Payloads of small integers such as LEVEL in percent, encoded in advance
+PERCENT_PAYLOADS = tuple(b"%d" % percent for percent in range(101))
+
+# Payloads of enumerated states, indexed by value
+ROTARY_HANDLE_VALUES = (
+    b"closed",
+    b"tilted",
+    b"open",
+)
+SMOKE_DETECTOR_VALUES = (
+    b"off",
+    b"primary",
+    b"intrusion",
+    b"secondary",
+)
+
+# Interned lower-case attribute names, shared by all channels
+LOWER_KEYS = {}
+
+
+def lower_key(key: str) -> str:
+    lc_key = LOWER_KEYS.get(key)
+    if lc_key is None:
+        lc_key = LOWER_KEYS[key] = sys.intern(key.lower())
+    return lc_key
+
+
+@lru_cache(maxsize=256)
+def parse_command_topic(topic: str) -> Optional[Tuple[str, int, str]]:
+    match = COMMAND_TOPIC_RE.fullmatch(topic)
+    if not match:
+        return None
+
+    address, channel, command = match.groups()
+    return address, int(channel), command
+
+
+def enum_payload(values: tuple, value: int) -> bytes:
+    if isinstance(value, int) and 0 <= value < len(values):
+        return values[value]
+    return b"unknown"
+
 
 class HomematicMqttBridge:
     def __init__(self):
         self._loop = asyncio.get_running_loop()
         self._ha_devices = {}
         self._ha_attributes = {}
+        self._ha_topics = {}
+        self._mqtt = None
+        self._subscriptions = set()
+        self._subscribe_tasks = set()
+        self._command_locks = defaultdict(asyncio.Lock)
+        self._command_semaphore = asyncio.Semaphore(COMMAND_CONCURRENCY)
+        # Commands get their own threads, so that calls hanging on the CCU
+        # can't starve asyncio-mqtt's connect(), which uses the default
+        # executor.
+        self._command_executor = ThreadPoolExecutor(max_workers=COMMAND_CONCURRENCY, thread_name_prefix="hm-command")
+        self._command_tasks = set()
+        self._maintenance_counts = {}
+        # Channels with unpublished attributes, filled by the XML-RPC thread
+        self._dirty_attributes = set()
+        self._attributes_lock = threading.Lock()
+        self._attributes_pending = False
+        self._outbox = deque()
+        self._outbox_event = asyncio.Event()
+        self._outbox_wakeup = False
+        self._outbox_limit = OUTBOX_MAX
+        self._outbox_compacting = False
+        self._last_sent = {}
+
+        # Event handlers by channel type and value key
+        self._event_handlers = {
+            # HmIP-BROLL(1,2)
+            ("KEY_TRANSCEIVER", "PRESS_SHORT"): self._handle_key_press,
+            ("KEY_TRANSCEIVER", "PRESS_LONG"): self._handle_key_press,
+            # HmIP-BROLL(3)
+            ("SHUTTER_TRANSMITTER", "LEVEL"): self._handle_level,
+            # HmIP-BROLL(4,5,6)
+            ("SHUTTER_VIRTUAL_RECEIVER", "LEVEL"): self._handle_level,
+            # HmIP-SRH(1)
+            ("ROTARY_HANDLE_TRANSCEIVER", "STATE"): self._handle_rotary_handle,
+            # HmIP-SWSD(1)
+            ("SMOKE_DETECTOR", "SMOKE_DETECTOR_ALARM_STATUS"): self._handle_smoke_detector,
+            # HmIP-BSM(3,4,5,6)
+            ("SWITCH_TRANSMITTER", "STATE"): self._handle_state,
+            ("SWITCH_VIRTUAL_RECEIVER", "STATE"): self._handle_state,
+        }
+        for flag in MAINTENANCE_FLAGS:
+            self._event_handlers[("MAINTENANCE", flag.upper())] = self._handle_maintenance
+
+    def _subscribe(self, topic: str) -> None:
+        self._loop.call_soon_threadsafe(self._add_subscription, topic)
+
+    def _add_subscription(self, topic: str) -> None:
+        # Subscriptions are renewed by _serve() after reconnecting.
+        self._subscriptions.add(topic)
+        if self._mqtt:
+            task = asyncio.create_task(self._mqtt_subscribe(self._mqtt, topic))
+            self._subscribe_tasks.add(task)
+            task.add_done_callback(self._subscribe_tasks.discard)
+
+    async def _mqtt_subscribe(self, mqtt, topic: str) -> None:
+        try:
+            await mqtt.subscribe(topic, qos=COMMAND_QOS)
+        except MqttError as exc:
+            # The topic stays in _subscriptions for the next reconnect.
+            logger.error("Failed to subscribe to %s: %s", topic, exc)
 
-    def _subscribe(self, mqtt, topic: str) -> None:
-        asyncio.run_coroutine_threadsafe(mqtt.subscribe(topic), self._loop)
+    def _publish(self, topic: str, message: Union[bool, bytes, dict, float, int, str], retain: Optional[bool] = True, qos: int = 0) -> None:
+        self._enqueue(((topic, self._encode(message), retain, qos),))
 
-    def _publish(self, mqtt, topic: str, message: Union[bool, bytes, dict, float, int, str], retain: Optional[bool] = True) -> None:
+    def _encode(self, message: Union[bool, bytes, dict, float, int, str]) -> bytes:
         if isinstance(message, dict):
-            message = json.dumps(message)
+            message = json_dumps(message)
         elif isinstance(message, bool):
-            message = [b"OFF", b"ON"][message]
-        elif isinstance(message, (float, int)):
+            message = b"ON" if message else b"OFF"
+        elif isinstance(message, int):
+            message = PERCENT_PAYLOADS[message] if 0 <= message <= 100 else b"%d" % message
+        elif isinstance(message, float):
             message = str(message)
 
         if isinstance(message, str):
             message = message.encode("utf-8")
 
         assert isinstance(message, bytes)
+        return message
+
+    def _enqueue(self, items) -> None:
+        self._outbox.extend(items)
+        # The publisher resets the flag before draining the outbox, so
+        # waking it up once per batch is sufficient. The flag, unlike the
+        # event, is set before the wake-up reaches the loop.
+        if not self._outbox_wakeup:
+            self._outbox_wakeup = True
+            self._loop.call_soon_threadsafe(self._outbox_event.set)
+        elif len(self._outbox) > self._outbox_limit and not self._outbox_compacting:
+            self._outbox_compacting = True
+            self._loop.call_soon_threadsafe(self._compact_outbox)
+
+    def _compact_outbox(self) -> None:
+        self._outbox_compacting = False
+        if self._mqtt:
+            # The publisher is draining the outbox anyway.
+            return
 
-        asyncio.run_coroutine_threadsafe(
-            mqtt.publish(topic, message, qos=2, retain=retain), self._loop
-        )
+        # Events keep coming while the broker is unreachable. Only the
+        # latest state is of interest, and triggers would be stale by the
+        # time the connection is back.
+        outbox = self._outbox
+        items = []
+        while outbox:
+            items.append(outbox.popleft())
+
+        retained = {}
+        for item in items:
+            if item[2]:
+                retained[item[0]] = item
+
+        outbox.extendleft(reversed(list(retained.values())))
+        self._outbox_limit = max(OUTBOX_MAX, 2 * len(retained))
+        logger.warning("Dropped %d queued messages while disconnected", len(items) - len(retained))
+
+    async def _publisher(self, mqtt) -> None:
+        outbox = self._outbox
+        while True:
+            await self._outbox_event.wait()
+            self._outbox_event.clear()
+            self._outbox_wakeup = False
+            items = []
+            while outbox:
+                items.append(outbox.popleft())
+
+            # Only the latest message of a retained topic is of interest,
+            # and only if it differs from what the broker already has.
+            retained = {}
+            transient = []
+            for item in items:
+                if item[2]:
+                    retained[item[0]] = item
+                else:
+                    transient.append(item)
+
+            last_sent = self._last_sent
+            batch = [item for topic, item in retained.items() if last_sent.get(topic) != item[1]]
+            batch += transient
 
-    def _publish_discovery(self, mqtt, component: str, node_id: str, object_id: str, config: dict, retain: Optional[bool] = True) -> None:
-        discovery_prefix = "homeassistant"
-        topic = f"{discovery_prefix}/{component}/{node_id}/{object_id}/config"
-        self._publish(mqtt, topic, config, retain=retain)
+            # Indices of the messages which went out, also when cancelled
+            sent = set()
 
-    def _publish_availability(self, mqtt, address: str, unreach: bool):
+            async def publish(index, topic, message, retain, qos):
+                await mqtt.publish(topic, message, qos=qos, retain=retain)
+                sent.add(index)
+
+            error = None
+            try:
+                results = await asyncio.gather(
+                    *(publish(index, *item) for index, item in enumerate(batch)),
+                    return_exceptions=True,
+                )
+                error = next((result for result in results if isinstance(result, BaseException)), None)
+            finally:
+                # Only unfinished messages are sent again. Replaying e.g. a
+                # PRESS_SHORT would trigger automations twice.
+                if len(last_sent) + len(sent) > LAST_SENT_MAX:
+                    last_sent.clear()
+                unsent = []
+                for index, item in enumerate(batch):
+                    if index not in sent:
+                        unsent.append(item)
+                    elif item[2]:
+                        last_sent[item[0]] = item[1]
+                if unsent:
+                    self._requeue(unsent)
+
+            if error:
+                raise error
+
+    def _requeue(self, items) -> None:
+        # Unsent messages go before the ones enqueued meanwhile, so that
+        # the latest message of a retained topic still wins.
+        self._outbox.extendleft(reversed(items))
+        self._outbox_event.set()
+
+    def _publish_discovery(self, pending: list, component: str, node_id: str, object_id: str, config: dict) -> None:
+        topic = f"{DISCOVERY_PREFIX}/{component}/{node_id}/{object_id}/config"
+        # Discovery configs must survive reconnects, so ask for delivery.
+        pending.append((topic, self._encode(config), True, 1))
+
+    def _publish_availability(self, topic: str, unreach: bool):
         if unreach:
-            value = "offline"
+            value = b"offline"
         else:
-            value = "online"
+            value = b"online"
 
-        base_topic = f"{MQTT_PREFIX}/{address}"
-        self._publish(mqtt, "%s/availability" % base_topic, value)
+        self._publish(topic, value)
 
     def _check_interface_id(self, interface_id: str) -> bool:
-        return interface_id == HM_INTERFACE_ID + "-" + HM_REMOTE
+        return interface_id == HM_EXPECTED_INTERFACE_ID
 
-    def _event_callback(self, mqtt, interface_id, address, value_key, value):
+    def _event_callback(self, interface_id, address, value_key, value):
         logger.debug(f"event_callback({interface_id}, {address}, {value_key}, {value})")
 
         if not self._check_interface_id(interface_id):
@@ -153,68 +404,120 @@ class HomematicMqttBridge:
             return
 
         attrs = self._ha_attributes.get(address)
-        if not attrs:
+        topics = self._ha_topics.get(address)
+        if not attrs or not topics:
             logger.error("Invalid address: %s", address)
             return
 
-        parent, index = address.split(":", 1)
-        base_topic = f"{MQTT_PREFIX}/{parent}/{index}"
-
         key = value_key
-        lc_key = key.lower()
+        lc_key = lower_key(key)
         old_value = attrs.get(lc_key)
         if old_value != value:
             attrs[lc_key] = value
-            self._publish(mqtt, "%s/attributes" % base_topic, attrs)
-
-        chan_type = attrs["type"]
-        if chan_type == "MAINTENANCE":
-            if key == "UNREACH":
-                self._publish_availability(mqtt, parent, value)
-
-            if lc_key in MAINTENANCE_FLAGS:
-                state = sum(attrs[flag] for flag in MAINTENANCE_FLAGS if flag in attrs)
-                self._publish(mqtt, "%s/state" % base_topic, bool(state))
-
-        # HmIP-BROLL(1,2)
-        elif chan_type == "KEY_TRANSCEIVER" and key in ("PRESS_SHORT", "PRESS_LONG"):
-            assert isinstance(value, bool)
-            self._publish(mqtt, f"{base_topic}/{key}", value, retain=False)
-        # HmIP-BROLL(3)
-        elif chan_type == "SHUTTER_TRANSMITTER" and key == "LEVEL":
-            self._publish(mqtt, "%s/state" % base_topic, int(round(value * 100)))
-        # HmIP-BROLL(4,5,6)
-        elif chan_type == "SHUTTER_VIRTUAL_RECEIVER" and key == "LEVEL":
-            self._publish(mqtt, "%s/state" % base_topic, int(round(value * 100)))
-        # HmIP-BROLL(7), HmIP-BSM(9)
-        elif chan_type.endswith("_WEEK_PROFILE") and key == "WEEK_PROGRAM_CHANNEL_LOCKS":
-            self._publish(mqtt, "%s/state" % base_topic, value)
-        # HmIP-SRH(1)
-        elif chan_type == "ROTARY_HANDLE_TRANSCEIVER" and key == "STATE":
-            text = ROTARY_HANDLE_VALUES.get(value, "unknown")
-            self._publish(mqtt, "%s/state" % base_topic, text)
-        # HmIP-SWSD(1)
-        elif chan_type == "SMOKE_DETECTOR" and key == "SMOKE_DETECTOR_ALARM_STATUS":
-            text = SMOKE_DETECTOR_VALUES.get(value, "unknown")
-            self._publish(mqtt, "%s/state" % base_topic, text)
-        # HmIP-BSM(3,4,5,6)
-        elif chan_type in ("SWITCH_TRANSMITTER", "SWITCH_VIRTUAL_RECEIVER") and key == "STATE":
-            self._publish(mqtt, "%s/state" % base_topic, value)
-
-    def _new_devices(self, mqtt, devices) -> None:
+            self._attributes_changed(address)
+
+        handler = self._event_handlers.get((attrs["type"], key))
+        if handler:
+            handler(address, topics, key, value, old_value)
+
+    def _attributes_changed(self, address: str) -> None:
+        # Only the first change of a burst wakes up the loop to start the
+        # timer. Later ones get published by the same flush.
+        with self._attributes_lock:
+            self._dirty_attributes.add(address)
+            if self._attributes_pending:
+                return
+            self._attributes_pending = True
+
+        self._loop.call_soon_threadsafe(self._loop.call_later, ATTRIBUTES_DELAY, self._flush_attributes)
+
+    def _flush_attributes(self) -> None:
+        with self._attributes_lock:
+            dirty = self._dirty_attributes
+            self._dirty_attributes = set()
+            self._attributes_pending = False
+
+        for address in dirty:
+            self._publish(self._ha_topics[address]["attributes"], self._ha_attributes[address])
+
+    def _handle_maintenance(self, address, topics, key, value, old_value):
+        if key == "UNREACH":
+            self._publish_availability(topics["availability"], value)
+
+        # Number of flags currently set, updated by the changed flag only.
+        # Unchanged states are dropped by the publisher, unless the broker
+        # might have lost them.
+        count = self._maintenance_counts.get(address, 0) + bool(value) - bool(old_value)
+        self._maintenance_counts[address] = count
+        self._publish(topics["state"], bool(count))
+
+    def _handle_key_press(self, address, topics, key, value, old_value):
+        assert isinstance(value, bool)
+        self._publish(topics[key], value, retain=False)
+
+    def _handle_level(self, address, topics, key, value, old_value):
+        # Round half up. LEVEL is almost never negative.
+        percent = value * 100
+        percent = int(percent + 0.5) if percent >= 0 else round(percent)
+        self._publish(topics["state"], percent)
+
+    def _handle_rotary_handle(self, address, topics, key, value, old_value):
+        self._publish(topics["state"], enum_payload(ROTARY_HANDLE_VALUES, value))
+
+    def _handle_smoke_detector(self, address, topics, key, value, old_value):
+        self._publish(topics["state"], enum_payload(SMOKE_DETECTOR_VALUES, value))
+
+    def _handle_state(self, address, topics, key, value, old_value):
+        self._publish(topics["state"], value)
+
+    def _entity_config(self, device: dict, topics: dict, name: str, address: str, **config) -> dict:
+        return {
+            **config,
+            "availability_topic": topics["availability"],
+            "device": device,
+            "json_attributes_topic": topics["attributes"],
+            "name": name,
+            "unique_id": "Homematic-%s" % address,
+        }
+
+    def _new_devices(self, devices) -> None:
         logger.debug("new_devices()")
+        # Discovery configs are handed to the publisher in one batch.
+        discovery = []
         for dev in devices:
             address = dev.get("ADDRESS")
             devtype = dev.get("TYPE")
             if address and devtype:
-                self._ha_attributes[address] = {
-                    k.lower(): v for k, v in dev.items() if v not in ("", [])
-                }
+                # Channel types are compared on every event. Interning lets
+                # those comparisons succeed on identity.
+                devtype = sys.intern(devtype)
+                attrs = self._ha_attributes[address] = {}
+                for k, v in dev.items():
+                    if v != "" and v != []:
+                        attrs[lower_key(k)] = v
+                attrs["type"] = devtype
+                self._maintenance_counts.pop(address, None)
+
+                # HmIP-BROLL(7), HmIP-BSM(9)
+                if devtype.endswith("_WEEK_PROFILE"):
+                    self._event_handlers[(devtype, "WEEK_PROGRAM_CHANNEL_LOCKS")] = self._handle_state
 
                 index = dev.get("INDEX")
                 parent = dev.get("PARENT")
                 parent_type = dev.get("PARENT_TYPE")
 
+                if parent and index is not None:
+                    # Topics used by _event_callback, built once per channel
+                    parent_topic = f"{MQTT_PREFIX}/{parent}"
+                    base_topic = f"{parent_topic}/{index}"
+                    self._ha_topics[address] = {
+                        "attributes": f"{base_topic}/attributes",
+                        "availability": f"{parent_topic}/availability",
+                        "state": f"{base_topic}/state",
+                        "PRESS_SHORT": f"{base_topic}/PRESS_SHORT",
+                        "PRESS_LONG": f"{base_topic}/PRESS_LONG",
+                    }
+
                 if not parent:
                     self._ha_devices[address] = {
                         "name": f"{devtype}_{address}",
@@ -232,86 +535,73 @@ class HomematicMqttBridge:
                 elif parent in self._ha_devices and index is not None:
                     node_id = f"{parent_type}_{parent}"
                     object_id = f"{index}-{devtype}"
-                    parent_topic = f"{MQTT_PREFIX}/{parent}"
-                    base_topic = f"{parent_topic}/{index}"
-                    config = {
-                        "device": self._ha_devices[parent],
-                    }
+                    device = self._ha_devices[parent]
+                    topics = self._ha_topics[address]
+                    name = f"{parent_type} {devtype} {address}"
+                    component = CHANNEL_COMPONENTS.get(devtype)
 
-                    if devtype in BINARY_SENSOR_TYPES:
+                    if component == "binary_sensor":
                         # https://www.home-assistant.io/integrations/binary_sensor.mqtt/
-                        config["availability_topic"] = "%s/availability" % parent_topic
-                        config["json_attributes_topic"] = "%s/attributes" % base_topic
-                        config["name"] = f"{parent_type} {devtype} {address}"
-                        config["state_topic"] = "%s/state" % base_topic
-                        config["unique_id"] = "Homematic-%s" % address
-                        self._publish_discovery(mqtt, "binary_sensor", node_id, object_id, config)
-
-                    elif devtype in SENSOR_TYPES:
+                        config = self._entity_config(device, topics, name, address, state_topic=topics["state"])
+                        self._publish_discovery(discovery, component, node_id, object_id, config)
+
+                    elif component == "sensor":
                         # https://www.home-assistant.io/integrations/sensor.mqtt/
-                        config["availability_topic"] = "%s/availability" % parent_topic
-                        config["json_attributes_topic"] = "%s/attributes" % base_topic
-                        config["name"] = f"{parent_type} {devtype} {address}"
-                        config["state_topic"] = "%s/state" % base_topic
-                        config["unique_id"] = "Homematic-%s" % address
+                        config = self._entity_config(device, topics, name, address, state_topic=topics["state"])
                         unit_of_measurement = SENSOR_UNITS.get(devtype)
                         if unit_of_measurement:
                             config["unit_of_measurement"] = unit_of_measurement
-                        self._publish_discovery(mqtt, "sensor", node_id, object_id, config)
+                        self._publish_discovery(discovery, component, node_id, object_id, config)
 
-                    elif devtype in DEVICE_TRIGGER_TYPES:
+                    elif component == "device_automation":
                         # https://www.home-assistant.io/integrations/device_trigger.mqtt/
-                        component = "device_automation"
-                        config["automation_type"] = "trigger"
-                        config["subtype"] = "button_%s" % index
-                        config["topic"] = "%s/PRESS_SHORT" % base_topic
+                        config = {
+                            **DEVICE_TRIGGER_TEMPLATE,
+                            "device": device,
+                            "subtype": "button_%s" % index,
+                        }
+                        config["topic"] = topics["PRESS_SHORT"]
                         config["type"] = "button_short_press"
-                        self._publish_discovery(mqtt, component, node_id, object_id + "-short", config)
-                        config["topic"] = "%s/PRESS_LONG" % base_topic
+                        self._publish_discovery(discovery, component, node_id, object_id + "-short", config)
+                        config["topic"] = topics["PRESS_LONG"]
                         config["type"] = "button_long_press"
-                        self._publish_discovery(mqtt, component, node_id, object_id + "-long", config)
+                        self._publish_discovery(discovery, component, node_id, object_id + "-long", config)
 
-                    elif devtype in COVER_TYPES:
+                    elif component == "cover":
                         # https://www.home-assistant.io/integrations/cover.mqtt/
-                        config["availability_topic"] = "%s/availability" % parent_topic
-                        config["command_topic"] = "%s/action" % base_topic
-                        self._subscribe(mqtt, config["command_topic"])
-                        config["device_class"] = "shutter"
-                        config["json_attributes_topic"] = "%s/attributes" % base_topic
-                        config["name"] = f"{parent_type} {devtype} {address}"
-                        config["payload_close"] = "move_down"
-                        config["payload_open"] = "move_up"
-                        config["payload_stop"] = "stop"
-                        config["position_closed"] = 0
-                        config["position_open"] = 100
-
                         new_index = HM_COVER_CHANNEL_MAP.get(index)
                         if new_index is not None:
-                            map_topic = f"{MQTT_PREFIX}/{parent}/%s" % new_index
-                            config["position_topic"] = "%s/state" % map_topic
+                            position_topic = f"{parent_topic}/{new_index}/state"
                         else:
-                            config["position_topic"] = "%s/state" % base_topic
-
-                        config["set_position_template"] = "{{ position / 100 }}"
-                        config["set_position_topic"] = "%s/set_level" % base_topic
-                        self._subscribe(mqtt, config["set_position_topic"])
-                        config["unique_id"] = "Homematic-%s" % address
-                        self._publish_discovery(mqtt, "cover", node_id, object_id, config)
-
-                    elif devtype in SWITCH_TYPES:
+                            position_topic = topics["state"]
+
+                        config = self._entity_config(
+                            device,
+                            topics,
+                            name,
+                            address,
+                            **COVER_TEMPLATE,
+                            command_topic="%s/action" % base_topic,
+                            position_topic=position_topic,
+                            set_position_topic="%s/set_level" % base_topic,
+                        )
+                        self._subscribe(config["command_topic"])
+                        self._subscribe(config["set_position_topic"])
+                        self._publish_discovery(discovery, component, node_id, object_id, config)
+
+                    elif component == "switch":
                         # https://www.home-assistant.io/integrations/switch.mqtt/
-                        config["availability_topic"] = "%s/availability" % parent_topic
-                        config["command_topic"] = "%s/action" % base_topic
-                        self._subscribe(mqtt, config["command_topic"])
-                        config["json_attributes_topic"] = "%s/attributes" % base_topic
-                        config["name"] = f"{parent_type} {devtype} {address}"
-                        config["payload_off"] = "off"
-                        config["payload_on"] = "on"
-                        config["state_off"] = "OFF"
-                        config["state_on"] = "ON"
-                        config["state_topic"] = "%s/state" % base_topic
-                        config["unique_id"] = "Homematic-%s" % address
-                        self._publish_discovery(mqtt, "switch", node_id, object_id, config)
+                        config = self._entity_config(
+                            device,
+                            topics,
+                            name,
+                            address,
+                            **SWITCH_TEMPLATE,
+                            command_topic="%s/action" % base_topic,
+                            state_topic=topics["state"],
+                        )
+                        self._subscribe(config["command_topic"])
+                        self._publish_discovery(discovery, component, node_id, object_id, config)
 
                     else:
                         logger.warning("Unhandled channel: %s", devtype)
@@ -319,75 +609,89 @@ class HomematicMqttBridge:
                 else:
                     logger.error("Parent not found!")
 
-    def _system_callback(self, mqtt, src, *args):
+        self._enqueue(discovery)
+
+    def _system_callback(self, src, *args):
         if src == "newDevices" and len(args) >= 2:
             if self._check_interface_id(args[0]):
-                self._new_devices(mqtt, args[1])
+                self._new_devices(args[1])
 
-    async def _process_packet(self, message, homematic):
-        try:
-            prefix, address, channel, name = message.topic.split("/")
-        except ValueError:
+    def _command_target(self, message, homematic):
+        parsed = parse_command_topic(message.topic)
+        if not parsed:
             logger.error("Invalid topic: %s", message.topic)
-            return
+            return None
 
-        if prefix != MQTT_PREFIX:
-            logger.error("Invalid prefix: %s", prefix)
-            return
-
-        try:
-            channel = int(channel)
-        except ValueError:
-            logger.error("Invalid channel: %s", channel)
-            return
+        address, channel, _ = parsed
 
         try:
             data = message.payload.decode("utf-8")
         except UnicodeDecodeError:
             logger.error("Invalid payload: %s", message.payload)
-            return
+            return None
 
         hmdevice = homematic.devices[HM_REMOTE].get(address)
         if not hmdevice:
             logger.error("Unable to find Homematic device %s", address)
-            return
+            return None
 
         hmchannel = hmdevice.CHANNELS.get(channel)
         if not hmchannel:
             logger.error("Invalid channel: %s", channel)
+            return None
+
+        return address, channel, hmdevice, hmchannel.TYPE, data
+
+    async def _process_action(self, message, homematic):
+        target = self._command_target(message, homematic)
+        if not target:
             return
 
-        if isinstance(hmdevice, GenericBlind) and hmchannel.TYPE in COVER_TYPES:
-            if name == "action":
-                if data not in ("move_up", "move_down", "stop"):
-                    logger.error("Invalid action: %s", data)
-                    return
+        address, channel, hmdevice, chan_type, data = target
+        if isinstance(hmdevice, GenericBlind) and chan_type in COVER_TYPES:
+            actions = ("move_up", "move_down", "stop")
+        elif isinstance(hmdevice, GenericSwitch) and chan_type in SWITCH_TYPES:
+            actions = ("on", "off")
+        else:
+            return
 
-                logger.debug("%s:%s: %s()", address, channel, data)
-                getattr(hmdevice, data)(channel)
+        if data not in actions:
+            logger.error("Invalid action: %s", data)
+            return
 
-            elif name == "set_level":
-                try:
-                    level = float(data)
-                except ValueError:
-                    logger.error("Invalid level: %s", data)
-                    return
+        logger.debug("%s:%s: %s()", address, channel, data)
+        await self._call_device(address, getattr(hmdevice, data), channel)
 
-                if not 0 <= level <= 1:
-                    logger.error("Invalid level: %s", level)
-                    return
+    async def _process_set_level(self, message, homematic):
+        target = self._command_target(message, homematic)
+        if not target:
+            return
+
+        address, channel, hmdevice, chan_type, data = target
+        if not isinstance(hmdevice, GenericBlind) or chan_type not in COVER_TYPES:
+            return
+
+        try:
+            level = float(data)
+        except ValueError:
+            logger.error("Invalid level: %s", data)
+            return
 
-                logger.debug("%s:%d: set_level(%s)", address, channel, level)
-                hmdevice.set_level(level, channel)
+        if not 0 <= level <= 1:
+            logger.error("Invalid level: %s", level)
+            return
 
-        elif isinstance(hmdevice, GenericSwitch) and hmchannel.TYPE in SWITCH_TYPES:
-            if name == "action":
-                if data not in ("on", "off"):
-                    logger.error("Invalid action: %s", data)
-                    return
+        logger.debug("%s:%d: set_level(%s)", address, channel, level)
+        await self._call_device(address, hmdevice.set_level, level, channel)
 
-                logger.debug("%s:%s: %s()", address, channel, data)
-                getattr(hmdevice, data)(channel)
+    async def _call_device(self, address: str, func, *args) -> None:
+        # XML-RPC calls block, so they run in the executor. Commands for the
+        # same device keep their order, e.g. stop after move_down.
+        async with self._command_locks[address], self._command_semaphore:
+            try:
+                await self._loop.run_in_executor(self._command_executor, func, *args)
+            except Exception:
+                logger.exception("%s: %s failed", address, func.__name__)
 
     def _xmlrpc_listen_url(self, url):
         if "://" not in url:
@@ -403,6 +707,43 @@ class HomematicMqttBridge:
             return p
         raise ValueError
 
+    async def _serve(self, mqtt, homematic) -> None:
+        self._mqtt = mqtt
+        # Messages may have been lost with the previous connection.
+        self._last_sent.clear()
+        tasks = (
+            asyncio.create_task(self._publisher(mqtt)),
+            asyncio.create_task(self._receiver(mqtt, homematic)),
+        )
+        try:
+            for topic in list(self._subscriptions):
+                await mqtt.subscribe(topic, qos=COMMAND_QOS)
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        finally:
+            self._mqtt = None
+            for task in tasks:
+                task.cancel()
+
+    async def _receiver(self, mqtt, homematic) -> None:
+        processors = {
+            "action": self._process_action,
+            "set_level": self._process_set_level,
+        }
+        # A single receiver creates the command tasks in arrival order, so
+        # that they queue up for each device's lock in that order, too.
+        async with mqtt.filtered_messages(f"{MQTT_PREFIX}/+/+/+") as messages:
+            async for message in messages:
+                parsed = parse_command_topic(message.topic)
+                if not parsed:
+                    logger.error("Invalid topic: %s", message.topic)
+                    continue
+
+                task = asyncio.create_task(processors[parsed[2]](message, homematic))
+                self._command_tasks.add(task)
+                task.add_done_callback(self._command_tasks.discard)
+
     async def run(self, broker: str, listen: str, connect: str) -> None:
         p = urlparse(broker, scheme="mqtt")
         if p.scheme not in ("mqtt", "mqtts") or not p.hostname:
@@ -412,45 +753,57 @@ class HomematicMqttBridge:
         if p.scheme == "mqtts":
             tls_context = ssl.create_default_context()
 
-        will = None
-        async with Client(
-            p.hostname,
-            port=p.port or p.scheme == "mqtt" and 1883 or 8883,
-            username=p.username,
-            password=p.password,
-            logger=logger,
-            tls_context=tls_context,
-            will=will,
-        ) as mqtt:
-            xmlrpc_local = self._xmlrpc_listen_url(listen)
-            xmlrpc_remote = self._xmlrpc_connect_url(connect)
-            homematic = HMConnection(
-                interface_id=HM_INTERFACE_ID,
-                local=xmlrpc_local.hostname,
-                localport=xmlrpc_local.port or 0,
-                remotes={
-                    HM_REMOTE: {
-                        "ip": xmlrpc_remote.hostname,
-                        "port": xmlrpc_remote.port,
-                        "path": xmlrpc_remote.path or "",
-                        "username": xmlrpc_remote.username or "Admin",
-                        "password": xmlrpc_remote.password or "",
-                    }
-                },
-                eventcallback=partial(self._event_callback, mqtt),
-                systemcallback=partial(self._system_callback, mqtt),
-            )
-
-            try:
-                homematic.start()
-            except AttributeError:
-                sys.exit(1)
+        xmlrpc_local = self._xmlrpc_listen_url(listen)
+        xmlrpc_remote = self._xmlrpc_connect_url(connect)
+        homematic = HMConnection(
+            interface_id=HM_INTERFACE_ID,
+            local=xmlrpc_local.hostname,
+            localport=xmlrpc_local.port or 0,
+            remotes={
+                HM_REMOTE: {
+                    "ip": xmlrpc_remote.hostname,
+                    "port": xmlrpc_remote.port,
+                    "path": xmlrpc_remote.path or "",
+                    "username": xmlrpc_remote.username or "Admin",
+                    "password": xmlrpc_remote.password or "",
+                }
+            },
+            eventcallback=self._event_callback,
+            systemcallback=self._system_callback,
+        )
 
-            async with mqtt.unfiltered_messages() as messages:
-                async for message in messages:
-                    await self._process_packet(message, homematic)
+        # Until the broker is connected, publishes wait in the outbox.
+        try:
+            homematic.start()
+        except AttributeError:
+            sys.exit(1)
 
+        will = None
+        delay = MQTT_RECONNECT_DELAY_MIN
+        try:
+            while True:
+                try:
+                    async with Client(
+                        p.hostname,
+                        port=p.port or p.scheme == "mqtt" and 1883 or 8883,
+                        username=p.username,
+                        password=p.password,
+                        logger=logger,
+                        tls_context=tls_context,
+                        will=will,
+                        keepalive=MQTT_KEEPALIVE,
+                    ) as mqtt:
+                        delay = MQTT_RECONNECT_DELAY_MIN
+                        await self._serve(mqtt, homematic)
+                except MqttError as exc:
+                    logger.error("MQTT error: %s", exc)
+
+                logger.warning("Reconnecting to MQTT broker in %d seconds", delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MQTT_RECONNECT_DELAY_MAX)
+        finally:
             homematic.stop()
+            self._command_executor.shutdown(wait=False)
 
 
 async def async_main(cfg: dict) -> None:
@@ -494,8 +847,8 @@ def options() -> dict:
     filename = args.config or cfg["config"]
 
     try:
-        with open(filename, "r") as f:
-            cfg.update(json.load(f))
+        with open(filename, "rb") as f:
+            cfg.update(json_loads(f.read()))
     except OSError as exc:
         if args.config or not isinstance(exc, FileNotFoundError):
             logger.error("Failed to open configuration file: %s", exc)
@@ -514,9 +867,6 @@ def options() -> dict:
 def main():
     try:
         asyncio.run(async_main(options()))
-    except MqttError as exc:
-        logger.critical("MQTT error: %s", exc)
-        sys.exit(1)
     except KeyboardInterrupt:
         pass
 